@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import hashlib
+
+
+class FileCache:
+    """JSON file cache for API responses, keyed by (endpoint, ticker, date)."""
+
+    def __init__(self, root=".cache", refresh=False):
+        self.root = root
+        self.refresh = refresh  # Skip reads but still store fresh values
+
+    def _path(self, key):
+        endpoint, ticker, date = key
+        digest = hashlib.md5(f"{endpoint}|{ticker}|{date}".encode()).hexdigest()
+        return os.path.join(self.root, endpoint, ticker or "_all", f"{digest}.json")
+
+    def get(self, key, ttl):
+        """Return the cached value for key, or None if missing or expired.
+
+        An entry expires once it is older than either ttl or the ttl it was stored with (None = never expires).
+        """
+        if self.refresh:
+            return None
+
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        age = time.time() - entry.get("ts", 0)
+        for limit in (ttl, entry.get("ttl")):
+            if limit is not None and age > limit:
+                return None
+        return entry.get("data")
+
+    def set(self, key, value, ttl=None):
+        """Store value for key."""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"ts": time.time(), "ttl": ttl, "data": value}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
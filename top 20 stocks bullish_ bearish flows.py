@@ -1,48 +1,112 @@
 import os
+import argparse
 import pandas as pd
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import numpy as np
 import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import pytz
-import yfinance as yf
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from tools.cache import FileCache
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # Fall back to the pandas groupby aggregation
+
+try:
+    import pandas_market_calendars as mcal
+except ImportError:
+    mcal = None  # Fall back to a regular-hours clock check
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None  # Fall back to DataFrame.to_csv
+
+parser = argparse.ArgumentParser(description="Options Flow Analysis - Top 20 Bullish/Bearish Stocks")
+parser.add_argument("--no-cache", action="store_true", help="refetch everything instead of reading the on-disk API cache (fresh responses are still cached)")
+args = parser.parse_args()
 
 # Load environment variables
 load_dotenv()
 API_KEY = os.getenv("UNUSUAL_WHALES_API_KEY")
 
+API_BASE_URL = "https://api.unusualwhales.com/api"
+MAX_WORKERS = 32  # Max concurrent API requests
+MAX_RETRIES = 3  # Retries on 429 / 5xx responses
+MAX_RATE_LIMIT_WAIT = 60  # Longest pause (seconds) taken from rate limit headers
+
+# On-disk API cache TTLs (seconds, None = never expires)
+SCREENER_TTL = 24 * 60 * 60  # Screener / market caps: 1 day
+OPEN_SESSION_FLOWS_TTL = 5 * 60  # Flows for a session still trading: 5 minutes
+cache = FileCache(".cache", refresh=args.no_cache)
+
 # Check if API key is set
 if not API_KEY:
     print("❌ UNUSUAL_WHALES_API_KEY not found in .env file! Create .env with: UNUSUAL_WHALES_API_KEY=your_key_here | Get key from: https://unusualwhales.com/")
     exit(1)
 
+# Shared HTTP session so every request reuses pooled keep-alive connections
+session = requests.Session()
+session.headers.update({"Authorization": f"Bearer {API_KEY}"})
+session.mount("https://", HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=MAX_RETRIES, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=["GET"], raise_on_status=False,
+                      respect_retry_after_header=False)  # 429s are handled by api_get
+))
+
 # Define current time in Eastern Time
 et_tz = pytz.timezone('US/Eastern')
 now_et = datetime.now(et_tz)
 current_time_decimal = (now_et - now_et.replace(hour=9, minute=30, second=0, microsecond=0)).total_seconds() / 3600
 
-# Global SPY ticker used for market data
-spy = yf.Ticker("SPY")
+# NYSE trading calendar, loaded on first use
+@lru_cache(maxsize=1)
+def get_nyse_calendar():
+    return mcal.get_calendar('NYSE')
 
-# Determine if market is open using yfinance
+# Determine if market is open from the NYSE calendar (no network call)
+@lru_cache(maxsize=1)
 def is_market_open():
     try:
-        info = spy.info
-        market_state = info.get('regularMarketState', 'UNKNOWN')
-        is_open = market_state == 'REGULAR'
-        return is_open, f"Market {market_state.lower()}"
+        schedule = get_nyse_calendar().schedule(start_date=now_et.date(), end_date=now_et.date())
+        if schedule.empty:
+            return False, "Market holiday"
+        today = schedule.iloc[0]
+        is_open = today['market_open'] <= now_et <= today['market_close']
+        return is_open, f"Market {'open' if is_open else 'closed'}"
     except Exception as e:
-        return False, "API error"
+        # Calendar unavailable: assume regular hours, weekdays 9:30 AM - 4:00 PM ET
+        is_open = now_et.weekday() < 5 and 0 <= current_time_decimal < 6.5
+        return is_open, f"Market {'open' if is_open else 'closed'} (clock check)"
 
 #determine the last trading session, used when the market is closed
 def get_last_trading_session():
     try:
-        hist = spy.history(start=now_et.date() - timedelta(days=5), end=now_et.date(), interval="1d")
-        return hist.index[-1].date().strftime("%Y-%m-%d") if not hist.empty else None
-    except:
-        return None
+        schedule = get_nyse_calendar().schedule(start_date=now_et.date() - timedelta(days=10), end_date=now_et.date())
+        closed = schedule[schedule['market_close'] <= now_et]
+        return closed.index[-1].strftime("%Y-%m-%d") if not closed.empty else None
+    except Exception as e:
+        # Calendar unavailable: use the most recent weekday before today
+        day = now_et.date() - timedelta(days=1)
+        while day.weekday() >= 5:
+            day -= timedelta(days=1)
+        return day.strftime("%Y-%m-%d")
 
 # Print market status and time
 market_status = is_market_open()
@@ -57,64 +121,106 @@ def get_analysis_date():
         last_session = get_last_trading_session()
         return last_session if last_session else now_et.strftime("%Y-%m-%d")
 
+# Market cap buckets by lower edge: Micro ($300M-$1B), Small ($1B-$2B), Mid ($2B-$10B), Large ($10B-$200B), Mega (>= $200B)
+MARKET_CAP_EDGES = np.array([300_000_000, 1_000_000_000, 2_000_000_000, 10_000_000_000, 200_000_000_000])
+MARKET_CAP_CATEGORIES = np.array(['micro_cap', 'small_cap', 'mid_cap', 'large_cap', 'mega_cap'])
+MARKET_CAP_MIN_OPEN_INTEREST = np.array([50, 100, 200, 500, 1000])
+MARKET_CAP_MIN_PREMIUM = np.array([5000, 10000, 20000, 50000, 100000])
+
 def filter_stocks_by_market_cap(stocks_list):
     if not stocks_list:
         return []
     
-    filtered_stocks = []
+    tickers = np.array([stock.get('ticker') or '' for stock in stocks_list], dtype=object)
+    market_caps = pd.to_numeric(pd.Series([stock.get('marketcap') for stock in stocks_list]), errors='coerce').fillna(0).to_numpy(dtype=np.float64)
     
-    for stock in stocks_list:
-        try:
-            ticker = stock.get('ticker')
-            if not ticker:
-                continue
-            
-            market_cap = float(stock.get('marketcap', 0))
-            
-            # Filter and categorize by market cap
-            if market_cap >= 200_000_000_000:  # Mega-cap (>= $200B)
-                category = 'mega_cap'
-                min_open_interest = 1000
-                min_premium_value = 100000
-            elif market_cap >= 10_000_000_000:  # Large-cap ($10B-$200B)
-                category = 'large_cap'
-                min_open_interest = 500
-                min_premium_value = 50000
-            elif market_cap >= 2_000_000_000:  # Mid-cap ($2B-$10B)
-                category = 'mid_cap'
-                min_open_interest = 200
-                min_premium_value = 20000
-            elif market_cap >= 1_000_000_000:  # Small-cap ($1B-$2B)
-                category = 'small_cap'
-                min_open_interest = 100
-                min_premium_value = 10000
-            elif market_cap >= 300_000_000:  # Micro-cap ($300M-$1B)
-                category = 'micro_cap'
-                min_open_interest = 50
-                min_premium_value = 5000
-            else:
-                continue  # Skip stocks below $300M market cap
-            
-            filtered_stocks.append({
-                'ticker': ticker,
-                'market_cap': market_cap,
-                'category': category,
-                'min_open_interest': min_open_interest,
-                'min_premium_value': min_premium_value
-            })
-            
-        except:
-            continue
+    missing_caps = int((market_caps == 0).sum())
+    if missing_caps:
+        print(f"⚠️ Skipped {missing_caps} stocks with missing or invalid market cap")
     
-    return filtered_stocks
+    # Filter and categorize by market cap; bucket -1 means below $300M and is skipped
+    bucket = np.searchsorted(MARKET_CAP_EDGES, market_caps, side='right') - 1
+    keep = (bucket >= 0) & np.isfinite(market_caps) & (tickers != '')
+    bucket = bucket[keep]
     
+    return pd.DataFrame({
+        'ticker': tickers[keep],
+        'market_cap': market_caps[keep],
+        'category': MARKET_CAP_CATEGORIES[bucket],
+        'min_open_interest': MARKET_CAP_MIN_OPEN_INTEREST[bucket],
+        'min_premium_value': MARKET_CAP_MIN_PREMIUM[bucket]
+    }).to_dict('records')
+    
+# Earliest time the next request may be sent, shared across worker threads
+rate_limit_lock = threading.Lock()
+rate_limit_resume_at = 0.0
+
+def pause_requests(seconds):
+    global rate_limit_resume_at
+    with rate_limit_lock:
+        rate_limit_resume_at = max(rate_limit_resume_at, time.time() + min(seconds, MAX_RATE_LIMIT_WAIT))
+
+def wait_for_rate_limit():
+    with rate_limit_lock:
+        delay = rate_limit_resume_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+def header_seconds(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# GET an Unusual Whales endpoint over the shared session, pausing only when the rate limit headers say so
+def api_get(url):
+    for attempt in range(MAX_RETRIES + 1):
+        wait_for_rate_limit()
+        response = session.get(url, timeout=30)
+        
+        if response.status_code == 429 and attempt < MAX_RETRIES:
+            # Honor Retry-After, backing off exponentially on repeated 429s
+            retry_after = header_seconds(response.headers.get('Retry-After')) or 0
+            pause_requests(max(retry_after, min(2 ** attempt, 30)))
+            continue
+        
+        # Quota nearly used up: hold off until the window resets (epoch seconds or seconds from now)
+        remaining = header_seconds(response.headers.get('X-RateLimit-Remaining'))
+        reset = header_seconds(response.headers.get('X-RateLimit-Reset'))
+        if remaining is not None and remaining <= 1 and reset is not None:
+            pause_requests(max(0, reset - time.time() if reset > 1e9 else reset))
+        return response
+
+# Flows for a closed session never change, so cache them forever
+def flows_ttl(date):
+    return None if date < now_et.strftime("%Y-%m-%d") else OPEN_SESSION_FLOWS_TTL
+
+# Fetch options flow alerts for a single ticker
+def fetch_ticker_flows(ticker, date):
+    cache_key = ('flow_alerts', ticker, date)
+    flows = cache.get(cache_key, flows_ttl(date))
+    if flows is not None:
+        return flows
+
+    try:
+        url = f"{API_BASE_URL}/option-trades/flow-alerts?ticker={ticker}&date={date}"
+        response = api_get(url)
+
+        if response.status_code == 200:
+            flows = json_loads(response.content).get('data', [])
+            cache.set(cache_key, flows, flows_ttl(date))
+            return flows
+    except Exception as e:
+        pass
+    return []
+
 #Fetch all analysis data: flows, market caps, and stock info
 def fetch_analysis_data(date=None, tickers=None):
     if not date:
         date = get_analysis_date()
     
     # Initialize return data
-    flows_data = []
+    flows_data = pd.DataFrame()
     market_caps = {}
     stock_info = {}
     stocks_universe = []
@@ -122,13 +228,21 @@ def fetch_analysis_data(date=None, tickers=None):
     
     try:
         # 1. Get stocks universe from screener
-        screener_url = "https://api.unusualwhales.com/api/screener/stocks"
-        headers = {"Authorization": f"Bearer {API_KEY}"}
-        response = requests.get(screener_url, headers=headers, timeout=30)
+        screener_key = ('screener', '', now_et.strftime("%Y-%m-%d"))
+        stocks = cache.get(screener_key, SCREENER_TTL)
         
-        if response.status_code == 200:
-            data = response.json()
-            stocks = data.get('data', [])
+        if stocks is None:
+            screener_url = f"{API_BASE_URL}/screener/stocks"
+            response = api_get(screener_url)
+            
+            if response.status_code == 200:
+                data = json_loads(response.content)
+                stocks = data.get('data', [])
+                cache.set(screener_key, stocks, SCREENER_TTL)
+            else:
+                print(f"❌ Screener API failed: {response.status_code}")
+        
+        if stocks is not None:
             stocks_universe = stocks  # Store for get_stock_universe functionality
             print(f"📈 Found {len(stocks)} stocks in universe")
             
@@ -138,62 +252,45 @@ def fetch_analysis_data(date=None, tickers=None):
             
             # Build market caps dict from filtered stocks
             market_caps = {stock['ticker']: stock['market_cap'] for stock in filtered_stocks}
-        else:
-            print(f"❌ Screener API failed: {response.status_code}")
+            
+            # Screener rows already carry the stock info for qualifying tickers
+            stock_info = {stock['ticker']: stock for stock in stocks if stock.get('ticker') in market_caps}
         
-        # 3. Get options flows ONLY for filtered stocks
+        # 3. Get options flows ONLY for filtered stocks, fetched concurrently
         if filtered_stocks:
-            qualifying_tickers = [stock['ticker'] for stock in filtered_stocks]
+            qualifying_tickers = list(dict.fromkeys(stock['ticker'] for stock in filtered_stocks))
             
-            for ticker in qualifying_tickers:
-                try:
-                    url = f"https://api.unusualwhales.com/api/option-trades/flow-alerts?ticker={ticker}&date={date}"
-                    response = requests.get(url, headers=headers, timeout=30)
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        flows = data.get('data', [])
-                        if flows:
-                            print(f"📊 Found {len(flows)} flows for {ticker}")
-                        
-                        for flow in flows:
-                            flow_data = {
-                                'ticker': flow.get('ticker'),
-                                'call_premium_ask_side': flow.get('call_premium_ask_side', 0),
-                                'call_premium_bid_side': flow.get('call_premium_bid_side', 0),
-                                'put_premium_ask_side': flow.get('put_premium_ask_side', 0),
-                                'put_premium_bid_side': flow.get('put_premium_bid_side', 0),
-                                'expiry': flow.get('expiry', ''),
-                                'date': flow.get('date', date),
-                                'volume': flow.get('volume', 0),
-                                'open_interest': flow.get('open_interest', 0),
-                                'total_premium': flow.get('total_premium', 0)
-                            }
-                            flows_data.append(flow_data)
-                    
-                    time.sleep(0.1)  # Rate limiting
+            # Collect flows column-wise instead of building a dict per flow
+            flow_defaults = {
+                'ticker': None,
+                'call_premium_ask_side': 0,
+                'call_premium_bid_side': 0,
+                'put_premium_ask_side': 0,
+                'put_premium_bid_side': 0,
+                'expiry': '',
+                'date': date,
+                'volume': 0,
+                'open_interest': 0,
+                'total_premium': 0
+            }
+            flow_columns = {field: [] for field in flow_defaults}
+            
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                results = executor.map(lambda t: fetch_ticker_flows(t, date), qualifying_tickers)
+                
+                for ticker, flows in zip(qualifying_tickers, results):
+                    if flows:
+                        print(f"📊 Found {len(flows)} flows for {ticker}")
                     
-                except Exception as e:
-                    continue
+                    for field, default in flow_defaults.items():
+                        flow_columns[field].extend(flow.get(field, default) for flow in flows)
+            
+            flows_data = pd.DataFrame(flow_columns)
+            numeric_fields = ['call_premium_ask_side', 'call_premium_bid_side', 'put_premium_ask_side',
+                              'put_premium_bid_side', 'volume', 'open_interest', 'total_premium']
+            flows_data[numeric_fields] = flows_data[numeric_fields].apply(pd.to_numeric, errors='coerce')
         else:
             print("❌ No qualifying stocks found")
-        
-        # 4. Get stock info for tickers with flow
-        flow_tickers = list(set([flow['ticker'] for flow in flows_data]))
-        
-        for ticker in flow_tickers:
-            try:
-                url = f"https://api.unusualwhales.com/api/stock/{ticker}/info"
-                response = requests.get(url, headers=headers, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    stock_info[ticker] = data.get('data', {})
-                
-                time.sleep(0.1)  # Rate limiting
-                
-            except Exception as e:
-                continue
             
     except Exception as e:
         pass
@@ -206,150 +303,126 @@ def fetch_analysis_data(date=None, tickers=None):
         'filtered_stocks': filtered_stocks
     }
 
-def calculate_dte_weight(expiry_date, current_date):
-    """Calculate DTE weight based on days to expiration."""
-    if not expiry_date or not current_date:
-        return 1.0  # Default weight if dates are missing
-    
-    try:
-        # Parse dates
-        if isinstance(expiry_date, str):
-            expiry = datetime.strptime(expiry_date, '%Y-%m-%d').date()
-        else:
-            expiry = expiry_date
-        
-        if isinstance(current_date, str):
-            current = datetime.strptime(current_date, '%Y-%m-%d').date()
-        else:
-            current = current_date
-        
-        # Calculate DTE
-        dte = (expiry - current).days
-        
-        # Apply weighting based on DTE ranges
-        if dte <= 4:  # 0-4 DTE: 1.0
-            return 1.0
-        elif dte <= 7:  # 5-7 DTE: 0.95
-            return 0.95
-        elif dte <= 14:  # 8-14 DTE: 0.9
-            return 0.9
-        elif dte <= 28:  # 15-28 DTE: 0.85
-            return 0.85
-        elif dte <= 84:  # 29-84 DTE: 0.8
-            return 0.8
-        elif dte <= 170:  # 85-170 DTE: 0.75
-            return 0.75
-        elif dte <= 365:  # 171-365 DTE: 0.7
-            return 0.7
-        else:  # 366+ DTE: 0.65
-            return 0.65
-            
-    except Exception:
-        return 1.0  # Default weight if date parsing fails
+# DTE weight buckets by upper edge: 0-4: 1.0, 5-7: 0.95, 8-14: 0.9, 15-28: 0.85, 29-84: 0.8, 85-170: 0.75, 171-365: 0.7, 366+: 0.65
+DTE_EDGES = np.array([4, 7, 14, 28, 84, 170, 365], dtype=np.int32)
+DTE_WEIGHTS = np.array([1.0, 0.95, 0.9, 0.85, 0.8, 0.75, 0.7, 0.65])
 
 def robust_zscore(x):
     """Calculate robust z-score using median and MAD."""
-    if len(x) == 0:
-        return np.zeros_like(x)
+    x = np.nan_to_num(np.asarray(x, dtype=np.float64))
+    if x.size == 0:
+        return x
     
     median = np.median(x)
     mad = np.median(np.abs(x - median))
     
-    if mad == 0:
-        return np.zeros_like(x)
+    return np.zeros_like(x) if mad == 0 else (x - median) / (1.4826 * mad)
+
+def _accumulate_flows(call_ask, call_bid, put_ask, put_bid, volume, open_interest, dte_bucket, label, dte_weights, n_tickers):
+    """Sum weighted bullish/bearish flow, volume and open interest per ticker label in a single pass."""
+    bull_out = np.zeros(n_tickers)
+    bear_out = np.zeros(n_tickers)
+    vol_out = np.zeros(n_tickers)
+    oi_out = np.zeros(n_tickers)
+    
+    for i in range(label.shape[0]):
+        w = dte_weights[dte_bucket[i]]
+        idx = label[i]
+        bull_out[idx] += (call_ask[i] + put_bid[i]) * volume[i] * w
+        bear_out[idx] += (put_ask[i] + call_bid[i]) * volume[i] * w
+        vol_out[idx] += volume[i]
+        oi_out[idx] += open_interest[i]
     
-    return (x - median) / (1.4826 * mad)
+    return bull_out, bear_out, vol_out, oi_out
+
+if njit is not None:
+    _accumulate_flows = njit(cache=True, fastmath=True)(_accumulate_flows)
+
+def select_top_n(df, mask, scores, top_n):
+    """Select the rows where mask is set with the top_n highest scores, best first."""
+    idx = np.flatnonzero(mask)
+    k = min(top_n, len(idx))
+    if k == 0:
+        return df.iloc[[]]
+    
+    # Partial partition is O(N); only the k selected rows get sorted
+    top = idx[np.argpartition(-scores[idx], k - 1)[:k]]
+    return df.iloc[top[np.argsort(-scores[top], kind='stable')]]
 
 def calculate_flow_rankings(data, market_caps=None, top_n=20):
     """Calculate flow rankings from options data."""
-    if not data:
+    if data is None or len(data) == 0:
         return None, None
     
-    # Group by ticker and calculate flows
-    flow_data = {}
+    numeric_cols = ['call_premium_ask_side', 'call_premium_bid_side', 'put_premium_ask_side',
+                    'put_premium_bid_side', 'volume', 'open_interest']
+    df = pd.DataFrame(data).reindex(columns=['ticker', 'expiry', 'date'] + numeric_cols)
+    df = df[df['ticker'].notna() & (df['ticker'] != '')].copy()
     
-    for option in data:
-        try:
-            ticker = option.get('ticker')
-            if not ticker:
-                continue
-            
-            # Extract flow data
-            call_premium_ask_side = option.get('call_premium_ask_side', 0)
-            call_premium_bid_side = option.get('call_premium_bid_side', 0)
-            put_premium_ask_side = option.get('put_premium_ask_side', 0)
-            put_premium_bid_side = option.get('put_premium_bid_side', 0)
-            expiry = option.get('expiry', '')
-            date = option.get('date', '')
-            volume = option.get('volume', 0)
-            open_interest = option.get('open_interest', 0)
-            
-            if ticker not in flow_data:
-                flow_data[ticker] = {
-                    'bullish_flow': 0,
-                    'bearish_flow': 0,
-                    'total_volume': 0,
-                    'total_open_interest': 0,
-                    'market_cap': market_caps.get(ticker, 0) if market_caps else 0
-                }
-            
-            # Calculate DTE weight
-            dte_weight = calculate_dte_weight(expiry, date)
-            
-            # Calculate flows using FS = Σ(Premium × Volume × w(DTE))
-            # Bullish = ask side calls + bid side puts
-            # Bearish = ask side puts + bid side calls
-            bullish_flow = (call_premium_ask_side + put_premium_bid_side) * volume * dte_weight
-            bearish_flow = (put_premium_ask_side + call_premium_bid_side) * volume * dte_weight
-            
-            flow_data[ticker]['bullish_flow'] += bullish_flow
-            flow_data[ticker]['bearish_flow'] += bearish_flow
-            flow_data[ticker]['total_volume'] += volume
-            flow_data[ticker]['total_open_interest'] += open_interest
-            
-        except Exception as e:
-            continue
+    # Missing or malformed numeric fields count as 0
+    for col in numeric_cols:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
     
-    # Convert to DataFrame
-    results = []
-    for ticker, data in flow_data.items():
-        bullish_flow = data['bullish_flow']
-        bearish_flow = data['bearish_flow']
-        net_flow = bullish_flow - bearish_flow
-        total_volume = data['total_volume']
-        total_open_interest = data['total_open_interest']
-        market_cap = data['market_cap']
-        
-        # Calculate relative flow (premium relative to market cap)
-        relative_flow = net_flow / market_cap if market_cap > 0 else 0
-        
-        # Calculate standardized score
-        if total_volume > 0:
-            standardized_score = (net_flow / total_volume) * np.sqrt(total_volume)
-        else:
-            standardized_score = 0
-        
-        results.append({
-            'ticker': ticker,
+    # Calculate DTE weights for all rows at once from the DTE_EDGES / DTE_WEIGHTS buckets
+    expiry = pd.to_datetime(df['expiry'], format='%Y-%m-%d', errors='coerce')
+    current = pd.to_datetime(df['date'], format='%Y-%m-%d', errors='coerce')
+    dte = (expiry - current).dt.days.fillna(0).to_numpy()
+    dte_bucket = np.searchsorted(DTE_EDGES, dte).astype(np.uint8)
+    
+    # Calculate flows using FS = Σ(Premium × Volume × w(DTE))
+    # Bullish = ask side calls + bid side puts
+    # Bearish = ask side puts + bid side calls
+    if njit is not None:
+        labels, tickers = pd.factorize(df['ticker'])
+        bullish_flow, bearish_flow, total_volume, total_open_interest = _accumulate_flows(
+            *(df[col].to_numpy(dtype=np.float64) for col in numeric_cols),
+            dte_bucket, labels.astype(np.uint32), DTE_WEIGHTS, len(tickers)
+        )
+        df = pd.DataFrame({
+            'ticker': tickers,
             'bullish_flow': bullish_flow,
             'bearish_flow': bearish_flow,
-            'net_flow': net_flow,
             'total_volume': total_volume,
-            'total_open_interest': total_open_interest,
-            'market_cap': market_cap,
-            'relative_flow': relative_flow,
-            'standardized_score': standardized_score
+            'total_open_interest': total_open_interest
         })
-    
-    # Create DataFrames
-    df = pd.DataFrame(results)
+    else:
+        df['dte_weight'] = DTE_WEIGHTS[dte_bucket]
+        df['bullish'] = (df['call_premium_ask_side'] + df['put_premium_bid_side']) * df['volume'] * df['dte_weight']
+        df['bearish'] = (df['put_premium_ask_side'] + df['call_premium_bid_side']) * df['volume'] * df['dte_weight']
+        
+        df = df.groupby('ticker', sort=False).agg(
+            bullish_flow=('bullish', 'sum'),
+            bearish_flow=('bearish', 'sum'),
+            total_volume=('volume', 'sum'),
+            total_open_interest=('open_interest', 'sum')
+        ).reset_index()
     
     if df.empty:
         return None, None
     
+    df['net_flow'] = df['bullish_flow'] - df['bearish_flow']
+    df['market_cap'] = df['ticker'].map(market_caps or {}).fillna(0)
+    
+    net_flow = df['net_flow'].to_numpy(dtype=np.float64)
+    total_volume = df['total_volume'].to_numpy(dtype=np.float64)
+    market_cap = df['market_cap'].to_numpy(dtype=np.float64)
+    
+    # Calculate relative flow (premium relative to market cap)
+    df['relative_flow'] = np.divide(net_flow, market_cap, out=np.zeros_like(net_flow), where=market_cap > 0)
+    
+    # Calculate standardized score
+    df['standardized_score'] = np.divide(net_flow, total_volume, out=np.zeros_like(net_flow), where=total_volume > 0) * np.sqrt(np.clip(total_volume, 0, None))
+    
+    # Calculate robust score (net flow z-score using median and MAD)
+    df['robust_score'] = robust_zscore(net_flow)
+    
+    df = df[['ticker', 'bullish_flow', 'bearish_flow', 'net_flow', 'total_volume', 'total_open_interest',
+             'market_cap', 'relative_flow', 'standardized_score', 'robust_score']]
+    
     # Separate bullish and bearish
-    bullish_df = df[df['net_flow'] > 0].nlargest(top_n, 'standardized_score')
-    bearish_df = df[df['net_flow'] < 0].nsmallest(top_n, 'standardized_score')
+    scores = df['standardized_score'].to_numpy()
+    bullish_df = select_top_n(df, df['net_flow'].to_numpy() > 0, scores, top_n)
+    bearish_df = select_top_n(df, df['net_flow'].to_numpy() < 0, -scores, top_n)
     
     return bullish_df, bearish_df
 
@@ -362,22 +435,19 @@ def display_market_cap_breakdown(bullish_df, bearish_df, filtered_stocks):
     print("\nMARKET CAP BREAKDOWN")
     print("=" * 30)
     
-    # Group stocks by category
-    categories = {}
-    for stock in filtered_stocks:
-        cat = stock['category']
-        if cat not in categories:
-            categories[cat] = []
-        categories[cat].append(stock['ticker'])
+    # Map tickers to categories, then split each ranking by category in one pass
+    cat_map = {stock['ticker']: stock['category'] for stock in filtered_stocks}
+    bullish_groups = {cat: group for cat, group in bullish_df.groupby(bullish_df['ticker'].map(cat_map), sort=False)}
+    bearish_groups = {cat: group for cat, group in bearish_df.groupby(bearish_df['ticker'].map(cat_map), sort=False)}
+    present_categories = set(cat_map.values())
     
     # Display each category
     for cat in ['micro_cap', 'small_cap', 'mid_cap', 'large_cap', 'mega_cap']:
-        tickers = categories.get(cat, [])
-        if not tickers:
+        if cat not in present_categories:
             continue
             
-        bullish_cat = bullish_df[bullish_df['ticker'].isin(tickers)] if not bullish_df.empty else pd.DataFrame()
-        bearish_cat = bearish_df[bearish_df['ticker'].isin(tickers)] if not bearish_df.empty else pd.DataFrame()
+        bullish_cat = bullish_groups.get(cat, bullish_df.iloc[:0])
+        bearish_cat = bearish_groups.get(cat, bearish_df.iloc[:0])
         
         print(f"\n{cat.replace('_', ' ').title()}: {len(bullish_cat)} bullish, {len(bearish_cat)} bearish")
         
@@ -395,7 +465,7 @@ def display_rankings(bullish_df, bearish_df):
     print("\nTOP 20 BULLISH FLOW STOCKS")
     print("=" * 50)
     if not bullish_df.empty:
-        display_cols = ['ticker', 'bullish_flow', 'bearish_flow', 'net_flow', 'total_volume', 'market_cap', 'relative_flow', 'standardized_score']
+        display_cols = ['ticker', 'bullish_flow', 'bearish_flow', 'net_flow', 'total_volume', 'market_cap', 'relative_flow', 'standardized_score', 'robust_score']
         print(bullish_df[display_cols].to_string(index=False, formatters={
             'bullish_flow': '{:,.2f}'.format,
             'bearish_flow': '{:,.2f}'.format,
@@ -403,7 +473,8 @@ def display_rankings(bullish_df, bearish_df):
             'total_volume': '{:,.0f}'.format,
             'market_cap': '{:,.2f}'.format,
             'relative_flow': '{:.6f}'.format,
-            'standardized_score': '{:.2f}'.format
+            'standardized_score': '{:.2f}'.format,
+            'robust_score': '{:.2f}'.format
         }))
     else:
         print("No bullish flows found")
@@ -411,7 +482,7 @@ def display_rankings(bullish_df, bearish_df):
     print("\nTOP 20 BEARISH FLOW STOCKS")
     print("=" * 50)
     if not bearish_df.empty:
-        display_cols = ['ticker', 'bullish_flow', 'bearish_flow', 'net_flow', 'total_volume', 'market_cap', 'relative_flow', 'standardized_score']
+        display_cols = ['ticker', 'bullish_flow', 'bearish_flow', 'net_flow', 'total_volume', 'market_cap', 'relative_flow', 'standardized_score', 'robust_score']
         print(bearish_df[display_cols].to_string(index=False, formatters={
             'bullish_flow': '{:,.2f}'.format,
             'bearish_flow': '{:,.2f}'.format,
@@ -419,12 +490,21 @@ def display_rankings(bullish_df, bearish_df):
             'total_volume': '{:,.0f}'.format,
             'market_cap': '{:,.2f}'.format,
             'relative_flow': '{:.6f}'.format,
-            'standardized_score': '{:.2f}'.format
+            'standardized_score': '{:.2f}'.format,
+            'robust_score': '{:.2f}'.format
         }))
     else:
         print("No bearish flows found")
 
 
+def save_rankings(df, filename):
+    """Save rankings to CSV, using pyarrow's multi-threaded writer when available."""
+    if pa is not None:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), filename)
+    else:
+        df.to_csv(filename, index=False)
+
+
 # Options Flow Analysis - Top 20 Bullish/Bearish Stocks
 print("Options Flow Analysis - Top 20 Bullish/Bearish Stocks")
 
@@ -439,7 +519,7 @@ analysis_data = fetch_analysis_data(analysis_date)
 print(f"📊 Retrieved {len(analysis_data['flows'])} flow records")
 print(f"📊 Filtered {len(analysis_data['filtered_stocks'])} stocks")
 
-if not analysis_data['flows']:
+if analysis_data['flows'].empty:
     print("❌ No options flow data retrieved")
     print("This could be due to:")
     print("1. API key issues")
@@ -455,12 +535,12 @@ display_market_cap_breakdown(bullish_df, bearish_df, analysis_data['filtered_sto
 # Save results
 if bullish_df is not None and not bullish_df.empty:
     filename = f'bullish_flow_rankings_{analysis_date}.csv'
-    bullish_df.to_csv(filename, index=False)
+    save_rankings(bullish_df, filename)
     print(f"💾 Bullish rankings saved to: {filename}")
 
 if bearish_df is not None and not bearish_df.empty:
     filename = f'bearish_flow_rankings_{analysis_date}.csv'
-    bearish_df.to_csv(filename, index=False)
+    save_rankings(bearish_df, filename)
     print(f"💾 Bearish rankings saved to: {filename}")
 
 print(f"✅ Analysis completed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")